@@ -1,20 +1,37 @@
 import os
+import re
 import json
+import hashlib
+import functools
+import time
 import logging
 import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
 from decimal import Decimal, InvalidOperation
-from typing import Optional, Tuple
+from typing import Iterable, Iterator, Optional, Tuple
 from zoneinfo import ZoneInfo
 
+import ijson
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ReadTimeoutError
+from urllib3.util.retry import Retry
 
 
 # --- ENV ---
 WOG_API_KEY = os.environ.get("WOG_API_KEY")
 TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 TELEGRAM_CHAT_ID = os.environ.get("TELEGRAM_CHAT_ID")
+# Можно указать несколько чатов через запятую
+TELEGRAM_CHAT_IDS = [c.strip() for c in (TELEGRAM_CHAT_ID or "").split(",") if c.strip()]
+# Не больше стольких одновременных запросов к Telegram (лимит ~30 сообщений/с)
+TELEGRAM_MAX_PARALLEL = 4
 
 BALANCE_THRESHOLD = Decimal(os.environ.get("BALANCE_THRESHOLD", "40000.00"))
+# Порог в копейках - все сравнения с балансом идут в int
+BALANCE_THRESHOLD_K = int(BALANCE_THRESHOLD.scaleb(2).to_integral_value())
 WOG_TIMEZONE = os.environ.get("WOG_TIMEZONE", "Europe/Kyiv")
 
 # Для WalletsRemains нужен именно WalletCode (UUID)
@@ -30,91 +47,449 @@ WOG_CREDIT_KEYWORDS = [
     if x.strip()
 ]
 
+# Кэш остатка на начало дня: он меняется раз в сутки, повторный запрос не нужен.
+# WOG_OPENING_TTL_SEC=0 отключает кэш
+WOG_OPENING_CACHE = os.environ.get("WOG_OPENING_CACHE", "/tmp/wog_opening_cache.json")
+WOG_OPENING_TTL_SEC = int(os.environ.get("WOG_OPENING_TTL_SEC", "86400"))
+
+# Если прошлый запуск видел баланс >= 1.5 * порога, в течение WOG_SKIP_TTL_SEC
+# запросы к WOG не делаем. WOG_SKIP_TTL_SEC=0 отключает пропуск
+WOG_LAST_OK_CACHE = os.environ.get("WOG_LAST_OK_CACHE", "/tmp/wog_last_ok.json")
+WOG_SKIP_TTL_SEC = int(os.environ.get("WOG_SKIP_TTL_SEC", "600"))
+
+# В течение WOG_ALERT_DEBOUNCE_SEC после уведомления повторное не отправляется,
+# если баланс не упал еще больше чем на WOG_ALERT_DROP_PCT процентов.
+# WOG_ALERT_DEBOUNCE_SEC=0 отключает подавление
+WOG_ALERT_STATE = os.environ.get("WOG_ALERT_STATE", "/tmp/wog_last_alert.json")
+WOG_ALERT_DEBOUNCE_SEC = int(os.environ.get("WOG_ALERT_DEBOUNCE_SEC", "3600"))
+WOG_ALERT_DROP_PCT = int(os.environ.get("WOG_ALERT_DROP_PCT", "5"))
+
 DEBUG_WOG = os.environ.get("DEBUG_WOG", "0") == "1"
-REQUEST_TIMEOUT = 30
+# (connect, read): зависшее подключение обрывается быстро, медленный ответ ждем дольше
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+REQUEST_TIMEOUT = (CONNECT_TIMEOUT, READ_TIMEOUT)
+
+# Интервал опроса в секундах для запуска долгоживущим процессом.
+# 0 - однократная проверка (cron / GitHub Actions)
+WOG_POLL_INTERVAL = int(os.environ.get("WOG_POLL_INTERVAL", "0"))
+# Пока баланс выше 2 * порога, после WOG_POLL_BACKOFF_AFTER таких проверок подряд
+# интервал удваивается (не больше WOG_POLL_MAX_INTERVAL); у порога - сброс к базовому
+WOG_POLL_MAX_INTERVAL = int(os.environ.get("WOG_POLL_MAX_INTERVAL", "3600"))
+WOG_POLL_BACKOFF_AFTER = int(os.environ.get("WOG_POLL_BACKOFF_AFTER", "5"))
 # --- /ENV ---
 
 
 logging.basicConfig(
-    level=logging.INFO,
+    level=logging.DEBUG if DEBUG_WOG else logging.INFO,
     format="%(asctime)s - %(levelname)s - %(message)s"
 )
+# В DEBUG urllib3 пишет строки запросов, а в URL лежат ключ WOG и токен бота
+logging.getLogger("urllib3").setLevel(logging.INFO)
+
+
+class _Lazy:
+    # Аргумент логирования, который вычисляется только если запись реально выводится
+    __slots__ = ("fn",)
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def __str__(self) -> str:
+        return str(self.fn())
+
+
+# Одна сессия на весь процесс: TCP/TLS-соединения к WOG и Telegram
+# переиспользуются между запросами и проверками
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://api-fuelcards.wog.ua/",
+    HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=4,
+        max_retries=Retry(
+            total=3,
+            connect=3,
+            read=2,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            # API WOG работает через POST, без этого повторы по статусу не выполняются
+            allowed_methods=["POST"],
+            # После исчерпания повторов отдаем ответ, статус проверяет raise_for_status
+            raise_on_status=False
+        )
+    )
+)
+# sendMessage не идемпотентен: после таймаута чтения или 5xx сообщение
+# могло уже уйти, поэтому повторяем только ошибки подключения и 429
+_SESSION.mount(
+    "https://api.telegram.org/",
+    HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=TELEGRAM_MAX_PARALLEL,
+        max_retries=Retry(
+            total=3,
+            connect=3,
+            read=0,
+            backoff_factor=0.5,
+            status_forcelist=[429],
+            allowed_methods=["POST"],
+            # Иначе вместо статуса и тела ответа Telegram в лог попадет RetryError
+            raise_on_status=False
+        )
+    )
+)
 
 
-def parse_decimal(value) -> Decimal:
-    if value is None:
-        return Decimal("0")
-    s = str(value).strip().replace(" ", "").replace("\u00A0", "").replace(",", ".")
+_DIRECTION_FIELDS = ("Direction", "direction", "OperationType", "operationType", "Type", "type")
+
+# Признаки направления операции: один скомпилированный regex на класс
+# вместо последовательных проверок подстрок
+_CREDIT_DIR_RE = re.compile("|".join(map(re.escape, (
+    "credit", "in", "incoming", "plus", "попов", "зарах", "возврат", "повернен"
+))))
+_DEBIT_DIR_RE = re.compile("|".join(map(re.escape, (
+    "debit", "out", "outgoing", "minus", "спис", "покуп", "оплат"
+))))
+# Пустой список ключевых слов дал бы regex, совпадающий с любой строкой
+_CREDIT_TEXT_RE = (
+    re.compile("|".join(map(re.escape, WOG_CREDIT_KEYWORDS)))
+    if WOG_CREDIT_KEYWORDS else None
+)
+
+
+# Пробелы/NBSP-разделители разрядов убираем, запятую меняем на точку - за один проход
+_DEC_TRANS = str.maketrans({" ": "", "\u00A0": "", ",": "."})
+
+# Тело запросов к WOG сериализуем сами (orjson), поэтому тип задаем явно.
+# На сессию его не ставим: Telegram получает form-data
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+_MONEY_TRANS = {ord(","): ord(" ")}
+
+# Неизменная часть уведомления; подставляется только сумма
+_ALERT_PREFIX = "🚨 *Внимание!* 🚨\n\nБаланс для проверки: *"
+_ALERT_SUFFIX = " грн.*"
+
+try:
+    _TZ = ZoneInfo(WOG_TIMEZONE)
+except Exception:
+    _TZ = None
+
+_UAH_NAMES = frozenset({"грн", "uah"})
+_UAH_CODES = frozenset({"UAH", "980"})
+_WALLET_CODE = (WOG_WALLET_CODE or "").strip()
+
+
+@dataclass(slots=True)
+class WalletDetail:
+    # Из ответа WalletsRemains дальше нужны только эти поля
+    wallet_code: str
+    wallet_name: str
+    value: str
+
+    @classmethod
+    def from_remains(cls, w: dict) -> "WalletDetail":
+        return cls(
+            wallet_code=str(w.get("WalletCode") or ""),
+            wallet_name=str(w.get("WalletName") or ""),
+            value=str(w.get("Value", 0)),
+        )
+
+
+# Одни и те же строки сумм повторяются во многих транзакциях,
+# поэтому разбор строк кэшируется; не-строки разбираются без кэша
+@functools.lru_cache(maxsize=2048)
+def _parse_kopecks_str(s: str) -> int:
+    s = s.translate(_DEC_TRANS)
+
+    # Быстрый путь для обычной записи "[-]123[.4[5]]" - только int-арифметика
+    digits = s[1:] if s[:1] in ("-", "+") else s
+    int_part, _, frac = digits.partition(".")
+    if (
+        int_part.isascii() and int_part.isdigit()
+        and len(frac) <= 2 and (not frac or (frac.isascii() and frac.isdigit()))
+    ):
+        kopecks = int(int_part) * 100 + int(frac.ljust(2, "0"))
+        return -kopecks if s[:1] == "-" else kopecks
+
+    # Экспонента, больше двух знаков после точки и т.п. - через Decimal
     try:
-        return Decimal(s)
-    except InvalidOperation:
-        return Decimal("0")
+        return int(Decimal(s).scaleb(2).to_integral_value())
+    except (InvalidOperation, ValueError, OverflowError):
+        return 0
+
+
+def parse_kopecks(value) -> int:
+    # Суммы в копейках: в цикле по транзакциям int-арифметика вместо Decimal
+    if value is None:
+        return 0
+    if isinstance(value, str):
+        return _parse_kopecks_str(value)
+    return _parse_kopecks_str.__wrapped__(str(value))
+
+
+def from_kopecks(kopecks: int) -> Decimal:
+    return Decimal(kopecks).scaleb(-2)
 
 
 def fmt_money(amount: Decimal) -> str:
-    return f"{amount:,.2f}".replace(",", " ")
+    return format(amount, ",.2f").translate(_MONEY_TRANS)
 
 
 def norm(v: str) -> str:
-    return " ".join(str(v or "").strip().lower().split())
+    # Принимает только str - приведение делает вызывающий
+    return " ".join(v.strip().lower().split())
 
 
 def now_in_tz() -> dt.datetime:
-    try:
-        return dt.datetime.now(ZoneInfo(WOG_TIMEZONE))
-    except Exception:
+    if _TZ is None:
         logging.warning("Не удалось применить таймзону %s, используем локальную.", WOG_TIMEZONE)
         return dt.datetime.now()
+    return dt.datetime.now(_TZ)
 
 
-def send_telegram_message(api_url: str, message: str, chat_id: str) -> None:
+def alert_is_debounced(last_alert: Optional[dict], message_hash: str, balance_k: Optional[int]) -> bool:
+    if not isinstance(last_alert, dict):
+        return False
+    try:
+        last_ts = float(last_alert.get("ts", 0))
+    except (TypeError, ValueError):
+        return False
+    if time.time() - last_ts >= WOG_ALERT_DEBOUNCE_SEC:
+        return False
+    if last_alert.get("hash") == message_hash:
+        return True
+
+    last_balance_k = last_alert.get("balance_k")
+    if balance_k is None or not isinstance(last_balance_k, int):
+        return False
+    # Текст другой, но баланс почти не изменился - повторно не беспокоим
+    return (last_balance_k - balance_k) * 100 <= abs(last_balance_k) * WOG_ALERT_DROP_PCT
+
+
+def is_read_timeout(e: requests.exceptions.RequestException) -> bool:
+    # С Retry на адаптере urllib3 оборачивает таймаут чтения в MaxRetryError,
+    # и requests отдает его как ConnectionError, а не ReadTimeout
+    if isinstance(e, requests.exceptions.ReadTimeout):
+        return True
+    return bool(e.args) and isinstance(getattr(e.args[0], "reason", None), ReadTimeoutError)
+
+
+def send_telegram_message(
+    api_url: str,
+    message: str,
+    chat_id: str,
+    session: requests.Session = _SESSION
+) -> bool:
     payload = {"chat_id": chat_id, "text": message, "parse_mode": "Markdown"}
     try:
-        r = requests.post(api_url, data=payload, timeout=REQUEST_TIMEOUT)
+        r = session.post(api_url, data=payload, timeout=REQUEST_TIMEOUT)
         if r.status_code == 200:
-            logging.info("Уведомление в Telegram отправлено.")
-        else:
-            logging.error("Ошибка Telegram API: %s - %s", r.status_code, r.text)
+            logging.info("Уведомление в Telegram отправлено (chat_id=%s).", chat_id)
+            return True
+        logging.error("Ошибка Telegram API: %s - %s", r.status_code, r.text)
+    except requests.exceptions.ConnectTimeout as e:
+        logging.error("Таймаут подключения к Telegram: %s", e)
     except requests.exceptions.RequestException as e:
-        logging.error("Сетевая ошибка Telegram: %s", e)
-
+        if is_read_timeout(e):
+            logging.error("Таймаут ответа Telegram: %s", e)
+        else:
+            logging.error("Сетевая ошибка Telegram: %s", e)
+    return False
+
+
+def notify_telegram(
+    api_url: str,
+    message: str,
+    chat_ids: list,
+    force: bool = False,
+    session: requests.Session = _SESSION,
+    balance_k: Optional[int] = None
+) -> None:
+    # Состояние подавления повторов хранится по каждому чату: чат, куда
+    # отправка не удалась, получит уведомление при следующей проверке
+    message_hash = hashlib.sha1(message.encode("utf-8")).hexdigest()
+    debounce = WOG_ALERT_DEBOUNCE_SEC > 0
+    state = read_json_file(WOG_ALERT_STATE) if debounce else {}
+    pending = [
+        cid for cid in chat_ids
+        if force or not debounce or not alert_is_debounced(state.get(cid), message_hash, balance_k)
+    ]
+    if not pending:
+        logging.info("Уведомление не отправлено: недавно уже отправлялось (debounced).")
+        return
 
-def wog_post(wog_api_url: str, action: str, body: dict) -> dict:
-    headers = {"Content-Type": "application/json"}
-    r = requests.post(
+    if len(pending) == 1:
+        sent = [send_telegram_message(api_url, message, pending[0], session)]
+    else:
+        # Чаты оповещаются параллельно; ошибка в одном не мешает остальным
+        with ThreadPoolExecutor(max_workers=min(len(pending), TELEGRAM_MAX_PARALLEL)) as ex:
+            sent = list(ex.map(lambda cid: send_telegram_message(api_url, message, cid, session), pending))
+
+    if any(sent) and debounce:
+        entry = {"hash": message_hash, "ts": time.time(), "balance_k": balance_k}
+        state = {cid: state[cid] for cid in chat_ids if isinstance(state.get(cid), dict)}
+        state.update((cid, entry) for cid, ok in zip(pending, sent) if ok)
+        write_json_file(WOG_ALERT_STATE, state)
+
+
+def wog_request(
+    wog_api_url: str,
+    action: str,
+    body: dict,
+    stream: bool = False,
+    session: requests.Session = _SESSION
+) -> requests.Response:
+    r = session.post(
         wog_api_url,
-        headers=headers,
-        json=body,
+        data=orjson.dumps(body),
+        headers=_JSON_HEADERS,
         params={"Action": action},
-        timeout=REQUEST_TIMEOUT
+        timeout=REQUEST_TIMEOUT,
+        stream=stream
     )
     r.raise_for_status()
-    data = r.json()
+    return r
+
+
+def wog_post(wog_api_url: str, action: str, body: dict, session: requests.Session = _SESSION) -> dict:
+    r = wog_request(wog_api_url, action, body, session=session)
+    data = orjson.loads(r.content)
     if str(data.get("status")) != "0":
         raise RuntimeError(f"WOG API error (Action={action}): {data}")
     return data
 
 
+def iter_transactions(r: requests.Response) -> Iterator[dict]:
+    # Список транзакций за день может быть большим: разбираем ответ потоково
+    # и отдаем по одной транзакции, не собирая весь JSON в памяти
+    r.raw.decode_content = True
+    status = None
+    has_list = False
+    events = ijson.parse(r.raw)
+    for prefix, event, value in events:
+        if prefix == "transactions" and event == "start_array":
+            has_list = True
+        elif prefix == "status":
+            status = str(value)
+            if status != "0":
+                raise RuntimeError(f"WOG API error (Action=Transaction): status={status}")
+        elif prefix == "transactions.item" and event in ("start_map", "start_array"):
+            builder = ijson.ObjectBuilder()
+            depth = 1
+            while depth:
+                builder.event(event, value)
+                prefix, event, value = next(events)
+                if event in ("start_map", "start_array"):
+                    depth += 1
+                elif event in ("end_map", "end_array"):
+                    depth -= 1
+            yield builder.value
+    if status is None:
+        raise RuntimeError("WOG API error (Action=Transaction): нет status в ответе")
+    if not has_list:
+        raise RuntimeError("Transaction не вернул список transactions")
+
+
+def read_json_file(path: str) -> dict:
+    try:
+        with open(path, "rb") as f:
+            data = orjson.loads(f.read())
+    except (OSError, ValueError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def write_json_file(path: str, data: dict) -> None:
+    # Пишем во временный файл и подменяем атомарно: параллельный запуск
+    # не прочитает наполовину записанный кэш
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(orjson.dumps(data))
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logging.warning("Не удалось сохранить %s: %s", path, e)
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+def load_opening_cache(cache_key: str) -> Optional[dict]:
+    if WOG_OPENING_TTL_SEC <= 0:
+        return None
+    entry = read_json_file(WOG_OPENING_CACHE).get(cache_key)
+    # Битая запись считается промахом кэша: ее перезапишет свежий ответ WOG,
+    # а запись без Value иначе дала бы остаток 0 и ложное уведомление
+    if not isinstance(entry, dict) or entry.get("Value") is None:
+        return None
+    try:
+        ts = float(entry["ts"])
+    except (KeyError, TypeError, ValueError):
+        return None
+    return {**entry, "ts": ts}
+
+
+def save_opening_cache(request_date: str, wallet_code: str, wallet: WalletDetail) -> None:
+    if WOG_OPENING_TTL_SEC <= 0:
+        return
+    # Храним только текущий день - записи за прошлые даты не нужны
+    data = {
+        f"{request_date}:{wallet_code}": {
+            "ts": time.time(),
+            "WalletCode": wallet.wallet_code,
+            "WalletName": wallet.wallet_name,
+            "Value": wallet.value,
+        }
+    }
+    write_json_file(WOG_OPENING_CACHE, data)
+
+
+def cached_balance_is_safe() -> bool:
+    if WOG_SKIP_TTL_SEC <= 0:
+        return False
+    last_ok = read_json_file(WOG_LAST_OK_CACHE)
+    try:
+        ts = float(last_ok["ts"])
+        balance_k = int(last_ok["balance_k"])
+    except (KeyError, TypeError, ValueError):
+        return False
+    # balance >= 1.5 * threshold без перехода к дробным числам
+    return time.time() - ts < WOG_SKIP_TTL_SEC and 2 * balance_k >= 3 * BALANCE_THRESHOLD_K
+
+
+def save_last_ok(balance_k: int) -> None:
+    if WOG_SKIP_TTL_SEC <= 0:
+        return
+    write_json_file(WOG_LAST_OK_CACHE, {"ts": time.time(), "balance_k": balance_k})
+
+
 def pick_uah_wallets(remains: list) -> list:
     wallets = []
     for w in remains:
-        goods_name = norm(w.get("GoodsName", ""))
-        goods_code = str(w.get("GoodsCode", "")).strip()
-        currency_code = str(w.get("CurrencyCode", "")).strip().upper()
-        if goods_name in {"грн", "uah"} or goods_code == "980" or currency_code in {"UAH", "980"}:
+        goods = str(w.get("GoodsName") or "").strip().lower()
+        code = str(w.get("GoodsCode") or "").strip()
+        cur = str(w.get("CurrencyCode") or "").strip().upper()
+        if goods in _UAH_NAMES or code == "980" or cur in _UAH_CODES:
             wallets.append(w)
     return wallets
 
 
 def select_wallet(uah_wallets: list) -> dict:
-    if WOG_WALLET_CODE:
-        selected = [w for w in uah_wallets if str(w.get("WalletCode", "")).strip() == WOG_WALLET_CODE.strip()]
-        if not selected:
+    if _WALLET_CODE:
+        # Первый совпавший кошелек, без сборки промежуточного списка
+        selected = next(
+            (w for w in uah_wallets if str(w.get("WalletCode", "")).strip() == _WALLET_CODE),
+            None
+        )
+        if selected is None:
             raise RuntimeError(
                 f"WOG_WALLET_CODE={WOG_WALLET_CODE} не найден. "
                 f"Доступные WalletCode: {[w.get('WalletCode') for w in uah_wallets]}"
             )
-        return selected[0]
+        return selected
 
     if len(uah_wallets) != 1:
         raise RuntimeError(
@@ -124,58 +499,80 @@ def select_wallet(uah_wallets: list) -> dict:
     return uah_wallets[0]
 
 
-def get_tx_amount(tx: dict) -> Optional[Decimal]:
-    # 1) если итоговая сумма готова - берем ее
-    summ_with_discount = parse_decimal(tx.get("summwithdiscount", -1))
-    if summ_with_discount != Decimal("-1"):
+def opening_wallet(wr: dict) -> WalletDetail:
+    remains = wr.get("remains", [])
+    if not isinstance(remains, list) or not remains:
+        raise RuntimeError("WOG API: пустой remains")
+
+    logging.debug("RAW remains: %s", _Lazy(lambda: json.dumps(remains, ensure_ascii=False)))
+
+    uah_wallets = pick_uah_wallets(remains)
+    if not uah_wallets:
+        raise RuntimeError(f"UAH кошельки не найдены. remains={remains}")
+
+    return WalletDetail.from_remains(select_wallet(uah_wallets))
+
+
+def get_tx_amount(tx: dict) -> Optional[int]:
+    # 1) если итоговая сумма готова - берем ее (-1 грн = еще не рассчитана)
+    summ_with_discount = parse_kopecks(tx.get("summwithdiscount", -1))
+    if summ_with_discount != -100:
         return summ_with_discount
 
     # 2) если итоговая еще не готова, берем сырой sum
-    raw_sum = parse_decimal(tx.get("sum", 0))
-    if raw_sum != Decimal("0"):
+    raw_sum = parse_kopecks(tx.get("sum", 0))
+    if raw_sum != 0:
         return raw_sum
 
     # 3) суммы нет
     return None
 
 
-def transaction_signed_amount(tx: dict) -> Optional[Decimal]:
+def transaction_signed_amount(tx: dict) -> Optional[int]:
     amount = get_tx_amount(tx)
     if amount is None:
         return None
 
-    if amount == Decimal("0"):
-        return Decimal("0")
+    if amount == 0:
+        return 0
     if amount < 0:
         return amount
 
-    direction_fields = ("Direction", "direction", "OperationType", "operationType", "Type", "type")
-    direction_value = norm(" ".join(str(tx.get(f, "")) for f in direction_fields))
+    # Берем первое непустое поле направления, без склейки всех полей
+    direction_value = ""
+    for f in _DIRECTION_FIELDS:
+        v = tx.get(f)
+        if v:
+            direction_value = str(v).lower()
+            break
 
-    if any(x in direction_value for x in ("credit", "in", "incoming", "plus", "попов", "зарах", "возврат", "повернен")):
+    if _CREDIT_DIR_RE.search(direction_value):
         return abs(amount)
 
-    if any(x in direction_value for x in ("debit", "out", "outgoing", "minus", "спис", "покуп", "оплат")):
+    if _DEBIT_DIR_RE.search(direction_value):
         return -abs(amount)
 
-    text = norm(f"{tx.get('goodsName', '')} {tx.get('walletname', '')} {tx.get('cardinfo', '')}")
-    if any(k in text for k in WOG_CREDIT_KEYWORDS):
-        return abs(amount)
+    if _CREDIT_TEXT_RE is not None:
+        text = norm(f"{tx.get('goodsName', '')} {tx.get('walletname', '')} {tx.get('cardinfo', '')}")
+        if _CREDIT_TEXT_RE.search(text):
+            return abs(amount)
 
     # По умолчанию считаем расходом
     return -abs(amount)
 
 
-def calc_today_delta(transactions: list, wallet_name: str) -> Tuple[Decimal, int, int, int]:
-    delta = Decimal("0")
+def calc_today_delta(transactions: Iterable[dict], wallet_name: str) -> Tuple[int, int, int, int]:
+    delta = 0
     matched = 0
     used = 0
     no_amount = 0
-    wallet_name_n = norm(wallet_name)
+    # Имя кошелька приходит из того же API, достаточно casefold без схлопывания пробелов
+    _cf = str.casefold
+    target = _cf(wallet_name.strip())
 
     for tx in transactions:
-        tx_wallet_name = norm(tx.get("walletname", ""))
-        if wallet_name_n and tx_wallet_name and tx_wallet_name != wallet_name_n:
+        name = _cf(str(tx.get("walletname") or "").strip())
+        if target and name and name != target:
             continue
 
         matched += 1
@@ -190,10 +587,11 @@ def calc_today_delta(transactions: list, wallet_name: str) -> Tuple[Decimal, int
     return delta, matched, used, no_amount
 
 
-def main() -> None:
-    if not all([WOG_API_KEY, TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID]):
-        logging.error("Не заданы WOG_API_KEY / TELEGRAM_BOT_TOKEN / TELEGRAM_CHAT_ID")
-        return
+def check_balance() -> Optional[int]:
+    # Возвращает рассчитанный баланс в копейках или None, если его нет
+    if cached_balance_is_safe():
+        logging.info("Пропуск: недавний баланс значительно выше порога (кэш %s).", WOG_LAST_OK_CACHE)
+        return None
 
     wog_api_url = f"https://api-fuelcards.wog.ua/{WOG_API_KEY}"
     tg_api_url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
@@ -202,39 +600,47 @@ def main() -> None:
     request_date = now_local.strftime("%Y%m%d")
     body = {"date": request_date, "version": "1.0"}
 
-    logging.info("Проверка баланса WOG. date=%s tz=%s", request_date, WOG_TIMEZONE)
+    logging.debug("Проверка баланса WOG. date=%s tz=%s", request_date, WOG_TIMEZONE)
 
     try:
-        # 1) Остаток на начало дня
-        wr = wog_post(wog_api_url, "WalletsRemains", body)
-        remains = wr.get("remains", [])
-        if not isinstance(remains, list) or not remains:
-            raise RuntimeError("WOG API: пустой remains")
-
-        if DEBUG_WOG:
-            logging.info("RAW remains: %s", json.dumps(remains, ensure_ascii=False))
-
-        uah_wallets = pick_uah_wallets(remains)
-        if not uah_wallets:
-            raise RuntimeError(f"UAH кошельки не найдены. remains={remains}")
-
-        wallet = select_wallet(uah_wallets)
-        opening_balance = parse_decimal(wallet.get("Value", 0))
+        # 1) Остаток на начало дня (из кэша, если уже запрашивали сегодня)
+        cache_key = f"{request_date}:{WOG_WALLET_CODE or ''}"
+        cached = load_opening_cache(cache_key)
+        opening_cached = cached is not None and time.time() - cached["ts"] < WOG_OPENING_TTL_SEC
+        if opening_cached:
+            wallet = WalletDetail.from_remains(cached)
+            tr = wog_request(wog_api_url, "Transaction", body, stream=True)
+        else:
+            # WalletsRemains и Transaction независимы, поэтому запрашиваем их параллельно
+            with ThreadPoolExecutor(max_workers=2) as ex:
+                f_wr = ex.submit(wog_post, wog_api_url, "WalletsRemains", body)
+                f_tr = ex.submit(wog_request, wog_api_url, "Transaction", body, True)
+            tr = f_tr.result()
+            try:
+                wallet = opening_wallet(f_wr.result())
+            except Exception:
+                tr.close()
+                raise
+            save_opening_cache(request_date, WOG_WALLET_CODE or "", wallet)
+
+        opening_k = parse_kopecks(wallet.value)
+        logging.debug("Кошелек: %s", _Lazy(lambda: asdict(wallet)))
 
         # 2) Дельта транзакций за день
-        tr = wog_post(wog_api_url, "Transaction", body)
-        transactions = tr.get("transactions", [])
-        if not isinstance(transactions, list):
-            logging.error("Transaction не вернул список transactions. Не отправляю уведомление.")
-            return
-
-        if DEBUG_WOG:
-            logging.info("RAW transactions: %s", json.dumps(transactions, ensure_ascii=False))
-
-        tx_delta, tx_matched, tx_used, tx_no_amount = calc_today_delta(
-            transactions,
-            str(wallet.get("WalletName", ""))
-        )
+        with tr:
+            transactions = iter_transactions(tr)
+            if DEBUG_WOG:
+                # Для дампа поток приходится собрать в список
+                transactions = list(transactions)
+                logging.debug(
+                    "RAW transactions: %s",
+                    _Lazy(lambda: json.dumps(transactions, ensure_ascii=False, default=str))
+                )
+
+            tx_delta_k, tx_matched, tx_used, tx_no_amount = calc_today_delta(
+                transactions,
+                wallet.wallet_name
+            )
 
         # Критичная защита: если ни одной транзакции не удалось учесть,
         # не отправляем, чтобы не показывать баланс на 00:00
@@ -244,38 +650,95 @@ def main() -> None:
                 "Чтобы не показывать баланс на 00:00, уведомление не отправляется.",
                 tx_matched, tx_no_amount
             )
-            return
+            return None
 
-        balance_for_check = opening_balance + tx_delta
+        balance_k = opening_k + tx_delta_k
+        save_last_ok(balance_k)
+        is_low = balance_k < BALANCE_THRESHOLD_K
 
+        # Одна строка на проверку; суммы в копейках, без форматирования
         logging.info(
-            "WalletCode=%s WalletName=%s Opening=%s DeltaTx=%s MatchedTx=%s UsedTx=%s NoAmountTx=%s BalanceForCheck=%s",
-            wallet.get("WalletCode"),
-            wallet.get("WalletName"),
-            fmt_money(opening_balance),
-            fmt_money(tx_delta),
+            "wog_check date=%s wallet=%s opening_k=%d opening_cached=%d delta_k=%d "
+            "tx_matched=%d tx_used=%d tx_no_amount=%d balance_k=%d threshold_k=%d status=%s",
+            request_date,
+            wallet.wallet_code,
+            opening_k,
+            opening_cached,
+            tx_delta_k,
             tx_matched,
             tx_used,
             tx_no_amount,
-            fmt_money(balance_for_check)
+            balance_k,
+            BALANCE_THRESHOLD_K,
+            "low" if is_low else "ok"
         )
 
         # Сравнение с порогом
-        if balance_for_check < BALANCE_THRESHOLD:
-            message = (
-                "🚨 *Внимание!* 🚨\n\n"
-                f"Баланс для проверки: *{fmt_money(balance_for_check)} грн.*"
-            )
-            send_telegram_message(tg_api_url, message, TELEGRAM_CHAT_ID)
-        else:
-            logging.info("Баланс в норме (>= %s грн).", fmt_money(BALANCE_THRESHOLD))
+        if is_low:
+            message = _ALERT_PREFIX + fmt_money(from_kopecks(balance_k)) + _ALERT_SUFFIX
+            notify_telegram(tg_api_url, message, TELEGRAM_CHAT_IDS, balance_k=balance_k)
 
+        return balance_k
+
+    except requests.exceptions.ConnectTimeout as e:
+        logging.error("Таймаут подключения к WOG: %s", e)
+    except ReadTimeoutError as e:
+        # Приходит напрямую из urllib3 при потоковом чтении Transaction
+        logging.error("Таймаут ответа WOG: %s", e)
     except requests.exceptions.RequestException as e:
-        logging.error("Ошибка сети WOG: %s", e)
-    except ValueError as e:
+        if is_read_timeout(e):
+            logging.error("Таймаут ответа WOG: %s", e)
+        else:
+            logging.error("Ошибка сети WOG: %s", e)
+    except (ValueError, ijson.JSONError) as e:
         logging.error("Ошибка JSON WOG: %s", e)
     except Exception as e:
         logging.error("Непредвиденная ошибка: %s", e)
+    return None
+
+
+def next_poll_interval(interval: int, high_streak: int, balance_k: Optional[int]) -> Tuple[int, int]:
+    if balance_k is None:
+        return interval, high_streak
+
+    # Близко к порогу (< 1.2 * порога) - сразу возвращаемся к базовому интервалу
+    if 5 * balance_k < 6 * BALANCE_THRESHOLD_K:
+        return WOG_POLL_INTERVAL, 0
+    if balance_k <= 2 * BALANCE_THRESHOLD_K:
+        return interval, 0
+
+    high_streak += 1
+    if high_streak >= WOG_POLL_BACKOFF_AFTER:
+        return min(interval * 2, max(WOG_POLL_MAX_INTERVAL, WOG_POLL_INTERVAL)), 0
+    return interval, high_streak
+
+
+def main() -> None:
+    if not all([WOG_API_KEY, TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_IDS]):
+        logging.error("Не заданы WOG_API_KEY / TELEGRAM_BOT_TOKEN / TELEGRAM_CHAT_ID")
+        return
+
+    if WOG_POLL_INTERVAL <= 0:
+        check_balance()
+        return
+
+    # Долгоживущий процесс: сессия, таймзона и regex-ы создаются один раз
+    logging.info("Режим опроса: проверка каждые %s с.", WOG_POLL_INTERVAL)
+    interval = WOG_POLL_INTERVAL
+    high_streak = 0
+    next_run = time.monotonic()
+    try:
+        while True:
+            balance_k = check_balance()
+            new_interval, high_streak = next_poll_interval(interval, high_streak, balance_k)
+            if new_interval != interval:
+                logging.info("Интервал опроса: %s -> %s с.", interval, new_interval)
+                interval = new_interval
+            # Тики, пропущенные за время долгой проверки, схлопываем в один
+            next_run = max(next_run + interval, time.monotonic())
+            time.sleep(max(0.0, next_run - time.monotonic()))
+    except KeyboardInterrupt:
+        logging.info("Опрос остановлен.")
 
 
 if __name__ == "__main__":